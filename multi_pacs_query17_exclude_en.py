@@ -3,22 +3,59 @@
 # modality/exclude filtering and proper CSV saving.
 
 import csv
+import os
 import argparse
+import asyncio
+import threading
+import time
 import warnings
+from collections import defaultdict
 from datetime import datetime, timedelta
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
 from pynetdicom import AE
-from pynetdicom.sop_class import StudyRootQueryRetrieveInformationModelFind
+from pynetdicom.sop_class import StudyRootQueryRetrieveInformationModelFind, Verification
 from pynetdicom.presentation import PresentationContext
 from pydicom.dataset import Dataset
+from pydicom.tag import Tag
 import pydicom
 
 warnings.filterwarnings("ignore")  # suppress pydicom warnings
 
+_TLS = threading.local()  # per-thread AE and C-FIND identifiers, neither is thread-safe
+
+# return keys of the C-FIND identifiers, per query level
+_QUERY_KEYS = {
+    "STUDY": (
+        "StudyDate",
+        "StudyInstanceUID",
+        "AccessionNumber",
+        "NumberOfStudyRelatedInstances",
+        "NumberOfStudyRelatedSeries",
+        "ModalitiesInStudy",
+        "StudyTime",
+    ),
+    "SERIES": ("StudyInstanceUID", "SeriesInstanceUID", "Modality"),
+}
+
+# tags read from each C-FIND response, in unpacking order
+_STUDY_RSP_TAGS = tuple(
+    Tag(keyword)
+    for keyword in (
+        "StudyInstanceUID",
+        "NumberOfStudyRelatedInstances",
+        "NumberOfStudyRelatedSeries",
+        "StudyDate",
+        "AccessionNumber",
+        "ModalitiesInStudy",
+    )
+)
+_SERIES_RSP_TAGS = (Tag("SeriesInstanceUID"), Tag("Modality"))
+
 
 def load_servers(cfg_file):
-    """Load servers from cfg file: ip port aet [max_workers]"""
-    servers = []
+    """Load servers from cfg file: ip port aet [max_workers]; repeated
+    ip/port/aet lines are merged keeping the largest max_workers"""
+    servers = {}
     with open(cfg_file, "r") as f:
         for line in f:
             line = line.strip()
@@ -26,177 +63,582 @@ def load_servers(cfg_file):
                 parts = line.split()
                 ip, port, aet = parts[:3]
                 max_workers = int(parts[3]) if len(parts) > 3 else 4
-                servers.append(
-                    {"ip": ip, "port": int(port), "aet": aet, "max_workers": max_workers}
-                )
-    return servers
-
-
-def query_server(ip, port, aet, start_datetime, end_datetime, local_aet):
-    """C-FIND at STUDY level"""
-    ae = AE(ae_title=local_aet)
-    context = PresentationContext()
-    context.abstract_syntax = StudyRootQueryRetrieveInformationModelFind
-    context.transfer_syntax = [
-        pydicom.uid.ExplicitVRLittleEndian,
-        pydicom.uid.ImplicitVRLittleEndian,
-    ]
-    ae.requested_contexts = [context]
-
-    ds = Dataset()
-    ds.QueryRetrieveLevel = "STUDY"
-    ds.StudyDate = start_datetime.strftime("%Y%m%d")
-    ds.StudyInstanceUID = ""
-    ds.AccessionNumber = ""
-    ds.NumberOfStudyRelatedInstances = ""
-    ds.NumberOfStudyRelatedSeries = ""
-    ds.ModalitiesInStudy = ""
-    ds.StudyTime = ""
-
-    if start_datetime.time() != datetime.min.time() or end_datetime.time() != datetime.max.time():
-        start_time_str = start_datetime.strftime("%H%M%S")
-        end_time_str = end_datetime.strftime("%H%M%S")
-        ds.StudyTime = f"{start_time_str}-{end_time_str}"
-
-    assoc = ae.associate(ip, port, ae_title=aet)
-    results = []
-    if assoc.is_established:
-        responses = assoc.send_c_find(ds, StudyRootQueryRetrieveInformationModelFind)
-        for (status, identifier) in responses:
-            if status and identifier:
-                study_uid = getattr(identifier, "StudyInstanceUID", None)
-                study_img = getattr(identifier, "NumberOfStudyRelatedInstances", None)
-                study_ser = getattr(identifier, "NumberOfStudyRelatedSeries", None)
-                study_date = getattr(identifier, "StudyDate", None)
-                accession = getattr(identifier, "AccessionNumber", None)
-                modality_raw = getattr(identifier, "ModalitiesInStudy", None)
-
-                try:
-                    study_img = int(study_img) if study_img is not None else 0
-                except Exception:
-                    study_img = 0
-                try:
-                    study_ser = int(study_ser) if study_ser is not None else 0
-                except Exception:
-                    study_ser = 0
-
-                if modality_raw:
-                    if isinstance(modality_raw, pydicom.multival.MultiValue):
-                        modalities_list = [str(m) for m in modality_raw]
-                    elif isinstance(modality_raw, (list, tuple)):
-                        modalities_list = [str(m) for m in modality_raw]
-                    else:
-                        modalities_list = [str(modality_raw)]
-                else:
-                    modalities_list = []
-
-                results.append(
-                    {
-                        "StudyDate": study_date,
-                        "StudyInstanceUID": study_uid,
-                        "NumberOfStudyRelatedInstances": study_img,
-                        "NumberOfStudyRelatedSeries": study_ser,
-                        "AccessionNumber": accession,
-                        "ModalityList": modalities_list,
-                    }
-                )
-        assoc.release()
-    return results
-
-
-def query_study_series(ip, port, aet, study_uid, local_aet):
-    """C-FIND at SERIES level"""
-    ae = AE(ae_title=local_aet)
-    context = PresentationContext()
-    context.abstract_syntax = StudyRootQueryRetrieveInformationModelFind
-    context.transfer_syntax = [
-        pydicom.uid.ExplicitVRLittleEndian,
-        pydicom.uid.ImplicitVRLittleEndian,
-    ]
-    ae.requested_contexts = [context]
-
-    ds = Dataset()
-    ds.QueryRetrieveLevel = "SERIES"
-    ds.StudyInstanceUID = study_uid
-    ds.SeriesInstanceUID = ""
-    ds.Modality = ""
-
-    assoc = ae.associate(ip, port, ae_title=aet)
-    series_list = []
-    if assoc.is_established:
-        responses = assoc.send_c_find(ds, StudyRootQueryRetrieveInformationModelFind)
-        for (status, identifier) in responses:
-            if status and identifier:
-                series_uid = getattr(identifier, "SeriesInstanceUID", None)
-                modality = getattr(identifier, "Modality", None)
-                if series_uid and modality:
-                    series_list.append((series_uid, modality))
-        assoc.release()
-    return series_list
-
-
-def query_server_with_4h_blocks(ip, port, aet, date_obj, local_aet):
-    """Split into 4-hour blocks if results count is 500"""
+                key = (ip, int(port), aet)
+                if key in servers:
+                    print(f"Duplicate server {ip} {port} {aet} in {cfg_file}, querying it once")
+                    servers[key]["max_workers"] = max(servers[key]["max_workers"], max_workers)
+                    continue
+                servers[key] = {"ip": ip, "port": int(port), "aet": aet, "max_workers": max_workers}
+    return list(servers.values())
+
+
+def _get_ae(local_aet):
+    """AE with the C-FIND and C-ECHO contexts, built once per thread"""
+    ae = getattr(_TLS, "ae", None)
+    if ae is None or ae.ae_title != local_aet:
+        context = PresentationContext()
+        context.abstract_syntax = StudyRootQueryRetrieveInformationModelFind
+        context.transfer_syntax = [
+            pydicom.uid.ExplicitVRLittleEndian,
+            pydicom.uid.ImplicitVRLittleEndian,
+        ]
+        echo_context = PresentationContext()
+        echo_context.abstract_syntax = Verification
+        echo_context.transfer_syntax = context.transfer_syntax
+        ae = AE(ae_title=local_aet)
+        ae.requested_contexts = [context, echo_context]
+        _TLS.ae = ae
+    return ae
+
+
+def _query_template(level):
+    """C-FIND identifier for level, built once per thread and reused; the
+    caller overwrites the matching keys before each send"""
+    templates = getattr(_TLS, "templates", None)
+    if templates is None:
+        templates = _TLS.templates = {}
+    ds = templates.get(level)
+    if ds is None:
+        ds = Dataset()
+        ds.QueryRetrieveLevel = level
+        for keyword in _QUERY_KEYS[level]:
+            setattr(ds, keyword, "")
+        templates[level] = ds
+    return ds
+
+
+def _count(value):
+    """IS count from a C-FIND response, 0 when missing or not a number"""
+    return int(value) if value and str(value).strip().isdigit() else 0
+
+
+class PacsSession:
+    """Association to a PACS server kept open for repeated STUDY- and
+    SERIES-level C-FIND"""
+
+    def __init__(self, ip, port, aet, local_aet):
+        self.ip = ip
+        self.port = port
+        self.aet = aet
+        self.local_aet = local_aet
+        self.assoc = None
+        self.connect()
+
+    def connect(self):
+        self.assoc = _get_ae(self.local_aet).associate(self.ip, self.port, ae_title=self.aet)
+        self.last_used = time.monotonic()
+
+    def is_alive(self, idle_seconds=30):
+        """C-ECHO over the open association to detect a dead peer; skipped
+        if it answered a request within the last idle_seconds"""
+        if self.assoc is None or not self.assoc.is_established:
+            return False
+        if time.monotonic() - self.last_used < idle_seconds:
+            return True
+        try:
+            status = self.assoc.send_c_echo()
+        except Exception:
+            return False
+        return bool(status) and status.Status == 0x0000
+
+    def find_studies(self, start_datetime, end_datetime):
+        """C-FIND at STUDY level"""
+        ds = _query_template("STUDY")
+        ds.StudyDate = start_datetime.strftime("%Y%m%d")
+        ds.StudyTime = ""
+
+        if start_datetime.time() != datetime.min.time() or end_datetime.time() != datetime.max.time():
+            start_time_str = start_datetime.strftime("%H%M%S")
+            end_time_str = end_datetime.strftime("%H%M%S")
+            ds.StudyTime = f"{start_time_str}-{end_time_str}"
+
+        results = []
+        if self.assoc.is_established:
+            responses = self.assoc.send_c_find(ds, StudyRootQueryRetrieveInformationModelFind)
+            for (status, identifier) in responses:
+                if status and identifier:
+                    study_uid, study_img, study_ser, study_date, accession, modality_raw = (
+                        identifier[tag].value if tag in identifier else None
+                        for tag in _STUDY_RSP_TAGS
+                    )
+                    study_img = _count(study_img)
+                    study_ser = _count(study_ser)
+                    modalities_list = (
+                        list(modality_raw)
+                        if hasattr(modality_raw, "__iter__") and not isinstance(modality_raw, str)
+                        else ([modality_raw] if modality_raw else [])
+                    )
+                    modalities = frozenset(str(m).upper() for m in modalities_list)
+
+                    results.append(
+                        {
+                            "StudyDate": study_date,
+                            "StudyInstanceUID": study_uid,
+                            "NumberOfStudyRelatedInstances": study_img,
+                            "NumberOfStudyRelatedSeries": study_ser,
+                            "AccessionNumber": accession,
+                            "ModalityList": modalities,
+                            "ModalityStr": ",".join(sorted(modalities)),
+                        }
+                    )
+            self.last_used = time.monotonic()
+        return results
+
+    def find_series(self, study_uid):
+        """C-FIND at SERIES level; (uid, modality as sent, uppercase modality)
+        per series, the raw value for the CSV and the uppercase one for the
+        filter"""
+        ds = _query_template("SERIES")
+        ds.StudyInstanceUID = study_uid
+
+        series_list = []
+        if self.assoc.is_established:
+            responses = self.assoc.send_c_find(ds, StudyRootQueryRetrieveInformationModelFind)
+            for (status, identifier) in responses:
+                if status and identifier:
+                    series_uid, modality = (
+                        identifier[tag].value if tag in identifier else None
+                        for tag in _SERIES_RSP_TAGS
+                    )
+                    if series_uid and modality:
+                        modality = str(modality)
+                        series_list.append((series_uid, modality, modality.upper()))
+            self.last_used = time.monotonic()
+        return series_list
+
+    def release(self):
+        if self.assoc is not None and self.assoc.is_established:
+            self.assoc.release()
+
+
+class SessionPool:
+    """Associations to a single server for the whole run: every C-FIND to it
+    runs in a thread while holding limit, on an idle PacsSession lent to
+    that worker, so at most max_workers associations are open at a time"""
+
+    def __init__(self, ip, port, aet, local_aet, max_workers):
+        self.ip = ip
+        self.port = port
+        self.aet = aet
+        self.local_aet = local_aet
+        self.limit = asyncio.Semaphore(max_workers)
+        self._idle = []
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def _run(self, query, *args):
+        """Run query(session, *args) on an idle session, reconnecting it if
+        the peer stopped answering, or on a new one if none is idle"""
+        with self._lock:
+            session = self._idle.pop() if self._idle else None
+        if session is not None and not session.is_alive():
+            session.release()
+            session.connect()
+        if session is None:
+            session = PacsSession(self.ip, self.port, self.aet, self.local_aet)
+        try:
+            return query(session, *args)
+        finally:
+            with self._lock:
+                closed = self._closed
+                if not closed:
+                    self._idle.append(session)
+            if closed:
+                session.release()
+
+    def find_studies(self, start_datetime, end_datetime):
+        return self._run(PacsSession.find_studies, start_datetime, end_datetime)
+
+    def find_series(self, study_uid):
+        return self._run(PacsSession.find_series, study_uid)
+
+    def close(self):
+        """Release the idle sessions; a session still in use (its query was
+        cancelled) is released by its thread when the query returns"""
+        with self._lock:
+            self._closed = True
+            idle = self._idle
+            self._idle = []
+        for session in idle:
+            session.release()
+
+
+async def query_server_with_4h_blocks(sessions, date_obj, split=False):
+    """Split into 4-hour blocks queried in parallel (within sessions.limit)
+    if results count is 500; split=True skips the full-day query and goes
+    straight to the blocks"""
     day_start = datetime.combine(date_obj.date(), datetime.min.time())
     day_end = datetime.combine(date_obj.date(), datetime.max.time())
 
-    partial_results = query_server(ip, port, aet, day_start, day_end, local_aet)
-    if len(partial_results) < 500:
-        return partial_results
+    async def find_studies(start_datetime, end_datetime):
+        async with sessions.limit:
+            return await asyncio.to_thread(sessions.find_studies, start_datetime, end_datetime)
 
-    results = []
+    if not split:
+        partial_results = await find_studies(day_start, day_end)
+        if len(partial_results) < 500:
+            return partial_results
+
+    blocks = []
     for i in range(6):
         block_start = day_start + timedelta(hours=4 * i)
         block_end = block_start + timedelta(hours=3, minutes=59, seconds=59)
         if block_end > day_end:
             block_end = day_end
-        block_results = query_server(ip, port, aet, block_start, block_end, local_aet)
-        results.extend(block_results)
-    return results
+        blocks.append((block_start, block_end))
 
-
-def modality_list_intersects(modality_list, check_list):
-    return not set(m.upper() for m in modality_list).isdisjoint(
-        set(m.upper() for m in check_list)
+    block_results = await asyncio.gather(
+        *(find_studies(block_start, block_end) for block_start, block_end in blocks)
     )
+    results = []
+    seen = set()
+    for block in block_results:
+        for study in block:
+            uid = study["StudyInstanceUID"]
+            if uid not in seen:
+                seen.add(uid)
+                results.append(study)
+    return results
 
 
-def modality_list_excludes(modality_list, exclude_list):
-    return modality_list_intersects(modality_list, exclude_list)
+def modality_filter_set(modalities):
+    """Uppercase frozenset of a --modality/--exclude list, empty for NONE or *"""
+    if not modalities or modalities in (["NONE"], ["*"]):
+        return frozenset()
+    return frozenset(m.upper() for m in modalities)
 
 
-def filter_study(study_modalities, modality_include, modality_exclude):
-    if modality_exclude and modality_exclude != ["NONE"]:
-        if modality_list_excludes(study_modalities, modality_exclude):
-            return False
-    if modality_include in (None, [], ["NONE"], ["*"]):
+def filter_study(study_modalities, include_fs, exclude_fs, has_include, has_exclude):
+    """Modalities are uppercase frozensets; has_include/has_exclude say
+    whether --modality/--exclude filter anything at all"""
+    if has_exclude and not study_modalities.isdisjoint(exclude_fs):
+        return False
+    if not has_include:
         return True
-    return modality_list_intersects(study_modalities, modality_include)
-
-
-def process_server(server, current_date, args):
-    """Retrieve studies and series from server"""
-    studies = {}
-    srv_results = query_server_with_4h_blocks(
-        server["ip"], server["port"], server["aet"], current_date, args.aet
-    )
+    return not study_modalities.isdisjoint(include_fs)
+
+
+class StudyTable:
+    """Studies returned by one server for one date, stored column-wise with
+    a StudyInstanceUID -> row lookup in index"""
+
+    def __init__(self, source_aet):
+        self.source_aet = source_aet
+        self.index = {}
+        self.uids = []
+        self.study_dates = []
+        self.accession = []
+        self.series_count = []
+        self.images_count = []
+        self.modalities_fs = []
+        self.modality_strs = []
+        self.series_lists = []
+        self.series_sets = []
+
+    def append(self, uid, study_date, accession, series_count, images_count, modalities_fs, modality_str):
+        self.index[uid] = len(self.uids)
+        self.uids.append(uid)
+        self.study_dates.append(study_date)
+        self.accession.append(accession)
+        self.series_count.append(series_count)
+        self.images_count.append(images_count)
+        self.modalities_fs.append(modalities_fs)
+        self.modality_strs.append(modality_str)
+        self.series_lists.append([])
+        self.series_sets.append(frozenset())
+
+    def set_series(self, row, series_list):
+        self.series_lists[row] = series_list
+        self.series_sets[row] = frozenset(s_uid for s_uid, _, _ in series_list)
+
+    def release(self, row):
+        """Drop the series of a row once its CSV rows are built"""
+        self.series_lists[row] = None
+        self.series_sets[row] = None
+
+
+async def query_studies(server, current_date, args, study_counts=None):
+    """Retrieve studies from server into a StudyTable; study_counts maps
+    (ip, port, aet, weekday) to the last study count seen, to skip the
+    full-day query on days expected to need 4-hour blocks"""
+    table = StudyTable(server["aet"])
+    count_key = (server["ip"], server["port"], server["aet"], current_date.weekday())
+    split = study_counts is not None and study_counts.get(count_key, 0) >= 500
+    srv_results = await query_server_with_4h_blocks(server["sessions"], current_date, split)
+    if study_counts is not None:
+        study_counts[count_key] = len(srv_results)
     for study in srv_results:
         uid = study.get("StudyInstanceUID")
         if not uid:
             continue
-        series_list = query_study_series(
-            server["ip"], server["port"], server["aet"], uid, args.aet
+        table.append(
+            uid,
+            study.get("StudyDate", current_date.strftime("%Y%m%d")),
+            study.get("AccessionNumber", ""),
+            study.get("NumberOfStudyRelatedSeries", 0),
+            study.get("NumberOfStudyRelatedInstances", 0),
+            study["ModalityList"],
+            study["ModalityStr"],
         )
-        studies[uid] = {
-            "SeriesCount": study.get("NumberOfStudyRelatedSeries", 0),
-            "ImagesCount": study.get("NumberOfStudyRelatedInstances", 0),
-            "SeriesList": series_list,
-            "StudyDate": study.get("StudyDate", current_date.strftime("%Y%m%d")),
-            "AccessionNumber": study.get("AccessionNumber", ""),
-            "Modalities": study.get("ModalityList", []),
-            "SourceServerAET": server["aet"],
-        }
-    return server["aet"], studies
+    return table
+
+
+async def process_server(server, table, args, on_study):
+    """Retrieve series for the studies in table through the server's
+    SessionPool, awaiting on_study(uid, table, row) as soon as the series
+    list of a row is known"""
+    sessions = server["sessions"]
+
+    async def fetch(uid, row):
+        async with sessions.limit:
+            series_list = await asyncio.to_thread(sessions.find_series, uid)
+        table.set_series(row, series_list)
+        await on_study(uid, table, row)
+
+    tasks = []
+    for uid, row in table.index.items():
+        # a study ruled out by its ModalitiesInStudy is still reported
+        # (its modalities count in the merge) but needs no SERIES
+        # query; studies the PACS left the tag empty for are queried
+        modalities = table.modalities_fs[row]
+        if modalities and not filter_study(
+            modalities, args.include_fs, args.exclude_fs, args.has_include, args.has_exclude
+        ):
+            await on_study(uid, table, row)
+            continue
+        tasks.append(fetch(uid, row))
+    await asyncio.gather(*tasks)
+
+
+def study_rows(uid, target, others, date_str, args):
+    """CSV rows for one study from its (table, row) on the target server
+    (None if the target lacks it) and on the other servers holding it;
+    the series missing on the target are only grouped for studies that
+    pass the modality filter"""
+    if target is not None:
+        st, i = target
+        modalities = st.modalities_fs[i]
+        tgt_series = st.series_sets[i]
+    else:
+        modalities = frozenset()
+        tgt_series = frozenset()
+    for table, row in others:
+        modalities |= table.modalities_fs[row]
+    if not filter_study(
+        modalities, args.include_fs, args.exclude_fs, args.has_include, args.has_exclude
+    ):
+        return []
+
+    by_srv = defaultdict(list)
+    for table, row in others:
+        for s_uid, s_mod, s_mod_upper in table.series_lists[row]:
+            if (
+                s_uid not in tgt_series
+                and s_mod_upper not in args.exclude_fs
+                and (not args.has_include or s_mod_upper in args.include_fs)
+            ):
+                by_srv[table.source_aet].append(f"{s_uid}({s_mod})")
+
+    if target is None:
+        # without a target entry the filter union is exactly the other servers' modalities
+        mods = ",".join(sorted(modalities))
+        return [
+            [date_str, uid, "", 0, 0, mods, s_aet, ", ".join(misslist)]
+            for s_aet, misslist in by_srv.items()
+        ]
+    study = [
+        st.study_dates[i],
+        uid,
+        st.accession[i],
+        st.series_count[i],
+        st.images_count[i],
+        st.modality_strs[i],
+    ]
+    if not by_srv:
+        return [study + [st.source_aet, ""]]
+    return [study + [s_aet, ", ".join(misslist)] for s_aet, misslist in by_srv.items()]
+
+
+class DayMerger:
+    """Joins one date's StudyTables by StudyInstanceUID and queues the CSV
+    rows of a study as soon as the last server holding it has reported"""
+
+    def __init__(self, date_str, args, rows_queue):
+        self.date_str = date_str
+        self.args = args
+        self.rows_queue = rows_queue
+        self.written_count = 0
+        self._pending = defaultdict(int)
+        self._target = {}
+        self._others = defaultdict(list)
+
+    def expect(self, table):
+        """Register the uids one server will report"""
+        for uid in table.index:
+            self._pending[uid] += 1
+
+    async def add_target(self, uid, table, row):
+        await self._add(uid, table, row, True)
+
+    async def add_other(self, uid, table, row):
+        await self._add(uid, table, row, False)
+
+    async def _add(self, uid, table, row, is_target):
+        if is_target:
+            self._target[uid] = (table, row)
+        else:
+            self._others[uid].append((table, row))
+        self._pending[uid] -= 1
+        if self._pending[uid]:
+            return
+        del self._pending[uid]
+        target = self._target.pop(uid, None)
+        others = self._others.pop(uid, [])
+        rows = study_rows(uid, target, others, self.date_str, self.args)
+        if target is not None:
+            target[0].release(target[1])
+        for table, row in others:
+            table.release(row)
+        if rows:
+            self.written_count += len(rows)
+            await self.rows_queue.put(rows)
+
+
+def _quote(value):
+    """CSV field quoted the way csv.writer's QUOTE_MINIMAL would"""
+    if value is None:
+        return ""
+    value = str(value)
+    if '"' in value:
+        return '"' + value.replace('"', '""') + '"'
+    if "," in value or "\n" in value or "\r" in value:
+        return '"' + value + '"'
+    return value
+
+
+def format_row(row):
+    """One CSV line for a study row; dates, UIDs and counts never need
+    quoting, so only the free-text columns go through _quote"""
+    study_date, uid, accession, series_count, images_count, mods, aet, missing = row
+    return (
+        f"{study_date or ''},{uid},{_quote(accession)},{series_count},{images_count},"
+        f"{_quote(mods)},{_quote(aet)},{_quote(missing)}\r\n"
+    )
+
+
+async def write_rows(csvfile, rows_queue):
+    """Writer task: drain row batches into the CSV until None arrives"""
+    while True:
+        rows = await rows_queue.get()
+        try:
+            if rows is None:
+                break
+            csvfile.write("".join([format_row(row) for row in rows]))
+            if rows_queue.empty():
+                csvfile.flush()
+        finally:
+            rows_queue.task_done()
+
+
+async def bootstrap_day(servers, current_date, args, study_counts):
+    """STUDY level on all servers for one date, one StudyTable per server"""
+    return await asyncio.gather(
+        *(query_studies(srv, current_date, args, study_counts) for srv in servers)
+    )
+
+
+async def run_day(target_server, servers, tables, date_str, args, rows_queue, writer_task):
+    """SERIES level on all servers for one date and queue its CSV rows;
+    returns the row count, or raises the writer's error if writer_task
+    stops before every row is written"""
+    # every uid knows how many servers will report it before the
+    # SERIES phase starts
+    merger = DayMerger(date_str, args, rows_queue)
+    for table in tables:
+        merger.expect(table)
+
+    async def queue_day():
+        # rows are queued per study as its last server reports
+        await asyncio.gather(
+            *(
+                process_server(
+                    srv,
+                    table,
+                    args,
+                    merger.add_target if srv is target_server else merger.add_other,
+                )
+                for srv, table in zip(servers, tables)
+            )
+        )
+        await rows_queue.join()
+
+    # a dead writer leaves producers blocked on a full queue and join()
+    # waiting forever, so wait on the writer as well
+    day_task = asyncio.create_task(queue_day())
+    await asyncio.wait({day_task, writer_task}, return_when=asyncio.FIRST_COMPLETED)
+    if not day_task.done():
+        day_task.cancel()
+        await asyncio.wait({day_task})
+        await writer_task
+        raise RuntimeError("CSV writer stopped before all rows were written")
+    await day_task
+    return merger.written_count
+
+
+async def run(servers, current_date, end_date, args, csvfile):
+    """Process every date from current_date to end_date on one event loop,
+    prefetching the next date's STUDY level while the current date's
+    SERIES level runs; both share each server's SessionPool limit"""
+    # one SessionPool per server for the whole run; every blocking
+    # pynetdicom call holds a slot of its limit, so max_workers threads
+    # per server are enough
+    for srv in servers:
+        srv["sessions"] = SessionPool(
+            srv["ip"], srv["port"], srv["aet"], args.aet, srv["max_workers"]
+        )
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=sum(srv["max_workers"] for srv in servers))
+    )
+    target_server = servers[0]
+    study_counts = {}
+    rows_queue = asyncio.Queue(maxsize=1000)
+    writer_task = asyncio.create_task(write_rows(csvfile, rows_queue))
+    next_tables = None
+    if current_date <= end_date:
+        next_tables = asyncio.create_task(
+            bootstrap_day(servers, current_date, args, study_counts)
+        )
+    try:
+        while current_date <= end_date:
+            date_str = current_date.strftime("%Y%m%d")
+            print(f"Processing: {date_str}")
+            # detached first, so the finally below only ever sees a prefetch
+            current_tables, next_tables = next_tables, None
+            tables = await current_tables
+            next_date = current_date + timedelta(days=1)
+            if next_date <= end_date:
+                next_tables = asyncio.create_task(
+                    bootstrap_day(servers, next_date, args, study_counts)
+                )
+            written_count = await run_day(
+                target_server, servers, tables, date_str, args, rows_queue, writer_task
+            )
+            print(f"Saved {written_count} records for date {date_str}")
+            current_date = next_date
+    finally:
+        if next_tables is not None:
+            # a prefetch that failed before the cancel still has its error read
+            next_tables.cancel()
+            await asyncio.wait({next_tables})
+            if not next_tables.cancelled() and next_tables.exception() is not None:
+                print(f"STUDY prefetch of the next date failed: {next_tables.exception()!r}")
+        for srv in servers:
+            await asyncio.to_thread(srv["sessions"].close)
+        if not writer_task.done():
+            stop = asyncio.create_task(rows_queue.put(None))
+            await asyncio.wait({stop, writer_task}, return_when=asyncio.FIRST_COMPLETED)
+            stop.cancel()
+        await writer_task
 
 
 def main():
@@ -209,6 +651,10 @@ def main():
     parser.add_argument("--output", default=None)
     parser.add_argument("--aet", default="MY_AET")
     args = parser.parse_args()
+    args.include_fs = modality_filter_set(args.modality)
+    args.exclude_fs = modality_filter_set(args.exclude)
+    args.has_include = bool(args.include_fs)
+    args.has_exclude = bool(args.exclude_fs)
 
     if not args.output:
         modality_str = "-".join(args.modality) if args.modality != ["NONE"] else "ALL"
@@ -220,140 +666,26 @@ def main():
         args.output = f"multi_pacs17_{modality_str}{exclude_str}_{args.start_date}_{args.end_date}.csv"
 
     servers = load_servers(args.cfg)
-    target_server = servers[0]
-    other_servers = servers[1:]
 
     current_date = datetime.strptime(args.start_date, "%Y%m%d")
     end_date = datetime.strptime(args.end_date, "%Y%m%d")
 
-    while current_date <= end_date:
-        print(f"Processing: {current_date.strftime('%Y%m%d')}")
-
-        # target server
-        _, target_studies = process_server(target_server, current_date, args)
-
-        # parallel retrieval from other servers
-        other_studies = {}
-        futures = []
-        for srv in other_servers:
-            executor = ThreadPoolExecutor(max_workers=srv["max_workers"])
-            futures.append(executor.submit(process_server, srv, current_date, args))
-        for f in as_completed(futures):
-            aet, studies = f.result()
-            for uid, data in studies.items():
-                other_studies.setdefault(uid, []).append(data)
-
-        all_uids = set(target_studies.keys()) | set(other_studies.keys())
-        filtered = set()
-        for uid in all_uids:
-            modalities = []
-            if uid in target_studies:
-                modalities += target_studies[uid]["Modalities"]
-            if uid in other_studies:
-                for entry in other_studies[uid]:
-                    modalities += entry["Modalities"]
-            modalities = list(set(m.upper() for m in modalities))
-            if filter_study(modalities, args.modality, args.exclude):
-                filtered.add(uid)
-
-        missing_series_map = {}
-        for uid in filtered:
-            tgt_series = set(
-                s[0] for s in target_studies.get(uid, {}).get("SeriesList", [])
+    write_header = not os.path.exists(args.output) or os.path.getsize(args.output) == 0
+    with open(args.output, "a", newline="", buffering=1 << 20) as csvfile:
+        if write_header:
+            csv.writer(csvfile).writerow(
+                [
+                    "StudyDate",
+                    "StudyInstanceUID",
+                    "AccessionNumber",
+                    "SeriesCount",
+                    "ImagesCount",
+                    "Modality",
+                    "SourceServerAET",
+                    "MissingSeries",
+                ]
             )
-            if uid in other_studies:
-                for entry in other_studies[uid]:
-                    for s_uid, s_mod in entry["SeriesList"]:
-                        if s_uid not in tgt_series:
-                            if (args.exclude == ["NONE"] or s_mod.upper() not in [e.upper() for e in args.exclude]) and (
-                                args.modality == ["NONE"]
-                                or s_mod.upper() in [m.upper() for m in args.modality]
-                            ):
-                                missing_series_map.setdefault(uid, []).append(
-                                    (s_uid, s_mod, entry["SourceServerAET"])
-                                )
-
-        with open(args.output, "a", newline="") as csvfile:
-            writer = csv.writer(csvfile)
-            if csvfile.tell() == 0:
-                writer.writerow(
-                    [
-                        "StudyDate",
-                        "StudyInstanceUID",
-                        "AccessionNumber",
-                        "SeriesCount",
-                        "ImagesCount",
-                        "Modality",
-                        "SourceServerAET",
-                        "MissingSeries",
-                    ]
-                )
-                
-            written_count = 0
-
-            for uid in filtered:
-                if uid in target_studies:
-                    st = target_studies[uid]
-                    mods = ",".join(sorted(set(m.upper() for m in st["Modalities"])))
-                    miss = missing_series_map.get(uid, [])
-                    if miss:
-                        by_srv = {}
-                        for s_uid, s_mod, s_aet in miss:
-                            by_srv.setdefault(s_aet, []).append(f"{s_uid}({s_mod})")
-                        for s_aet, misslist in by_srv.items():
-                            writer.writerow(
-                                [
-                                    st["StudyDate"],
-                                    uid,
-                                    st["AccessionNumber"],
-                                    st["SeriesCount"],
-                                    st["ImagesCount"],
-                                    mods,
-                                    s_aet,
-                                    ", ".join(misslist),
-                                ]
-                            )
-                            written_count += 1
-                    else:
-                        writer.writerow(
-                            [
-                                st["StudyDate"],
-                                uid,
-                                st["AccessionNumber"],
-                                st["SeriesCount"],
-                                st["ImagesCount"],
-                                mods,
-                                st["SourceServerAET"],
-                                "",
-                            ]
-                        )
-                        written_count += 1
-                elif uid in other_studies:
-                    all_mods = set()
-                    for entry in other_studies[uid]:
-                        all_mods.update(m.upper() for m in entry["Modalities"])
-                    mods = ",".join(sorted(all_mods))
-                    miss = missing_series_map.get(uid, [])
-                    by_srv = {}
-                    for s_uid, s_mod, s_aet in miss:
-                        by_srv.setdefault(s_aet, []).append(f"{s_uid}({s_mod})")
-                    for s_aet, misslist in by_srv.items():
-                        writer.writerow(
-                            [
-                                current_date.strftime("%Y%m%d"),
-                                uid,
-                                "",
-                                0,
-                                0,
-                                mods,
-                                s_aet,
-                                ", ".join(misslist),
-                            ]
-                        )
-                        written_count += 1
-
-        print(f"Saved {written_count} records for date {current_date.strftime('%Y%m%d')}")
-        current_date += timedelta(days=1)
+        asyncio.run(run(servers, current_date, end_date, args, csvfile))
 
 
 if __name__ == "__main__":